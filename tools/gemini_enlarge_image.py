@@ -7,13 +7,12 @@ Takes a 1K image and regenerates it at 4K resolution while preserving content.
 import sys
 import os
 import argparse
-import mimetypes
+import asyncio
 from pathlib import Path
 from dotenv import load_dotenv
-from google import genai
 from google.genai import types
 
-from concurrent.futures import ThreadPoolExecutor
+from gemini_generate_image import get_api_key, get_client, save_binary_file
 
 # Load environment variables
 script_dir = Path(__file__).parent
@@ -21,37 +20,83 @@ project_root = script_dir.parent
 env_path = project_root / ".env"
 load_dotenv(env_path)
 
-def save_binary_file(file_name: str, data: bytes) -> None:
-    """Save binary data to disk."""
-    with open(file_name, "wb") as f:
-        f.write(data)
-    print(f"File saved to: {file_name}")
+def _first_image_data(chunk):
+    """Return the data of the first inline image in a stream chunk, or None."""
+    if not chunk.candidates or not chunk.candidates[0].content:
+        return None
 
-def enlarge(
-    image_path: str,
-    output_path: str,
-    api_key: str = None
-) -> None:
-    """Upscale the given image to 4K."""
+    for part in chunk.candidates[0].content.parts:
+        if part.inline_data and part.inline_data.data:
+            return part.inline_data.data
+    return None
+
+MODEL = "gemini-3-pro-image-preview"
+
+def _max_concurrency_from_env(default: int = 16) -> int:
+    """Read GEMINI_MAX_CONCURRENCY, falling back to default if unset or not a positive int."""
+    value = os.environ.get("GEMINI_MAX_CONCURRENCY")
+    if not value:
+        return default
+    try:
+        limit = int(value)
+    except ValueError:
+        limit = 0
+    if limit < 1:
+        print(f"Warning: ignoring invalid GEMINI_MAX_CONCURRENCY={value!r}, using {default}", file=sys.stderr)
+        return default
+    return limit
+
+# Upper bound on concurrent Gemini requests when --workers is not given
+MAX_CONCURRENCY = _max_concurrency_from_env()
+
+def worker_count(num_tasks: int, requested: int = None) -> int:
+    """Use the requested count, or one worker per task up to MAX_CONCURRENCY; never below 1."""
+    if requested:
+        return max(1, requested)
+    return max(1, min(num_tasks, MAX_CONCURRENCY))
+
+# Fallback when the header bytes are not recognised
+_EXT_MIME = {
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".png": "image/png",
+    ".webp": "image/webp",
+}
+
+def _guess_mime_type(image_path: str, image_bytes: bytes) -> str:
+    """Detect the image type from its magic bytes, falling back to the suffix."""
+    if image_bytes[:3] == b"\xff\xd8\xff":
+        return "image/jpeg"
+    if image_bytes[:8] == b"\x89PNG\r\n\x1a\n":
+        return "image/png"
+    if image_bytes[:4] == b"RIFF" and image_bytes[8:12] == b"WEBP":
+        return "image/webp"
+    return _EXT_MIME.get(Path(image_path).suffix.lower(), "image/jpeg")
+
+def _resolve_api_key(api_key: str = None) -> str:
     if not api_key:
-        api_key = os.environ.get("GEMINI_API_KEY") or os.environ.get("GOOGLE_API_KEY")
+        api_key = get_api_key()
     
     if not api_key:
         print("Error: GEMINI_API_KEY environment variable not set", file=sys.stderr)
-        return
-
-    if not Path(image_path).exists():
+    return api_key
+
+def _build_request(image_path: str):
+    """Return (contents, config) for upscaling image_path, or None if it cannot be read."""
+    # Read input image. Not memory-mapped: Part.from_bytes needs real bytes and
+    # the SDK base64-encodes them into the request body, so a mapping would
+    # still be copied. enlarge_many builds requests inside its semaphore, so
+    # at most `workers` inputs are held in memory at once.
+    try:
+        image_bytes = Path(image_path).expanduser().read_bytes()
+    except FileNotFoundError:
         print(f"Error: Input image not found: {image_path}", file=sys.stderr)
-        return
+        return None
+    except OSError as e:
+        print(f"Error: Cannot read input image {image_path}: {e}", file=sys.stderr)
+        return None
 
-    client = genai.Client(api_key=api_key)
-    model = "gemini-3-pro-image-preview"
-
-    # Read input image
-    image_bytes = Path(image_path).expanduser().read_bytes()
-    mime_type, _ = mimetypes.guess_type(image_path)
-    if not mime_type:
-        mime_type = "image/jpeg"
+    mime_type = _guess_mime_type(image_path, image_bytes)
 
     # Construct Prompt
     prompt = "Upscale this image to 4K resolution. Maintain all details, text, and structure exactly. Do not add or remove elements. Just increase the resolution and sharpness."
@@ -79,32 +124,99 @@ def enlarge(
         ),
         tools=tools,
     )
+    return contents, generate_content_config
+
+def enlarge(
+    image_path: str,
+    output_path: str,
+    api_key: str = None
+) -> None:
+    """Upscale the given image to 4K."""
+    api_key = _resolve_api_key(api_key)
+    if not api_key:
+        return
+
+    request = _build_request(image_path)
+    if request is None:
+        return
+    contents, generate_content_config = request
+
+    client = get_client(api_key)
 
     print(f"Upscaling {image_path} to 4K...")
     
     try:
         # Using the generator loop as recommended for reliability
         for chunk in client.models.generate_content_stream(
-            model=model,
+            model=MODEL,
             contents=contents,
             config=generate_content_config,
         ):
-            if not chunk.candidates or not chunk.candidates[0].content:
-                continue
+            image_data = _first_image_data(chunk)
+            if image_data:
+                save_binary_file(output_path, image_data)
+                return # Done after saving first image
 
-            for part in chunk.candidates[0].content.parts:
-                if part.inline_data and part.inline_data.data:
-                    save_binary_file(output_path, part.inline_data.data)
-                    return # Done after saving first image
+        print(f"Error upscaling {image_path}: no image returned", file=sys.stderr)
 
     except Exception as e:
         print(f"Error upscaling {image_path}: {e}", file=sys.stderr)
 
+async def enlarge_async(
+    image_path: str,
+    output_path: str,
+    api_key: str = None
+) -> None:
+    """Upscale the given image to 4K on the running event loop."""
+    api_key = _resolve_api_key(api_key)
+    if not api_key:
+        return
+
+    request = _build_request(image_path)
+    if request is None:
+        return
+    contents, generate_content_config = request
+
+    client = get_client(api_key)
+
+    print(f"Upscaling {image_path} to 4K...")
+
+    try:
+        async for chunk in await client.aio.models.generate_content_stream(
+            model=MODEL,
+            contents=contents,
+            config=generate_content_config,
+        ):
+            image_data = _first_image_data(chunk)
+            if image_data:
+                # Write off the event loop so other requests keep streaming
+                await asyncio.to_thread(save_binary_file, output_path, image_data)
+                return # Done after saving first image
+
+        print(f"Error upscaling {image_path}: no image returned", file=sys.stderr)
+
+    except Exception as e:
+        print(f"Error upscaling {image_path}: {e}", file=sys.stderr)
+
+async def enlarge_many(pairs, api_key: str = None, workers: int = 5) -> None:
+    """Upscale (input, output) pairs concurrently, at most `workers` requests in flight."""
+    semaphore = asyncio.Semaphore(workers)
+
+    async def _run(inp, outp):
+        # Contain failures to their own image so the rest of the batch finishes
+        try:
+            async with semaphore:
+                await enlarge_async(inp, outp, api_key)
+        except Exception as e:
+            print(f"Error upscaling {inp}: {e}", file=sys.stderr)
+
+    await asyncio.gather(*[_run(inp, outp) for inp, outp in pairs])
+
 def main():
     parser = argparse.ArgumentParser(description="Upscale image(s) to 4K")
     parser.add_argument("--input", "-i", action="append", help="Input image path (can be used multiple times)")
     parser.add_argument("--output", "-o", action="append", help="Output image path (can be used multiple times)")
-    parser.add_argument("--workers", "-w", type=int, default=5, help="Number of parallel workers (default: 5)")
+    parser.add_argument("--workers", "-w", type=int, default=None, help="Number of parallel requests (default: one per image, capped by GEMINI_MAX_CONCURRENCY or 16)")
     
     args = parser.parse_args()
     
@@ -116,11 +228,10 @@ def main():
         print("Error: Number of inputs must match number of outputs.")
         sys.exit(1)
 
-    api_key = os.environ.get("GEMINI_API_KEY") or os.environ.get("GOOGLE_API_KEY")
+    api_key = get_api_key()
 
-    with ThreadPoolExecutor(max_workers=args.workers) as executor:
-        for inp, outp in zip(args.input, args.output):
-            executor.submit(enlarge, inp, outp, api_key)
+    workers = worker_count(len(args.input), args.workers)
+    asyncio.run(enlarge_many(zip(args.input, args.output), api_key, workers))
 
 if __name__ == "__main__":
     main()
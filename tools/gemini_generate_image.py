@@ -7,6 +7,7 @@ Supports text-only generation or text + image input.
 from typing import Optional, List
 from pathlib import Path
 import argparse
+import functools
 import mimetypes
 import os
 import sys
@@ -24,25 +25,46 @@ load_dotenv(env_path)
 
 def save_binary_file(file_name: str, data: bytes) -> None:
     """Save binary data to disk."""
-    with open(file_name, "wb") as f:
-        f.write(data)
+    # Write straight to the fd; the payload is already in memory, so the
+    # buffered io layer would only add another copy.
+    flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0)
+    fd = os.open(file_name, flags, 0o666)  # umask applies, as with open("wb")
+    try:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+    finally:
+        os.close(fd)
     print(f"File saved to: {file_name}")
 
 
+def get_api_key() -> Optional[str]:
+    """Return the Gemini API key from the environment (or .env), if set."""
+    return os.environ.get("GEMINI_API_KEY") or os.environ.get("GOOGLE_API_KEY")
+
+
+@functools.lru_cache(maxsize=1)
+def get_client(api_key: str) -> genai.Client:
+    """Return a client for api_key, shared across calls so connections are reused."""
+    return genai.Client(api_key=api_key)
+
+
 def generate(
     prompt: str,
     image_paths: Optional[List[str]] = None,
     output_prefix: str = "output",
     image_size: str = "1K", # kept in signature for compatibility but ignored
     aspect_ratio: Optional[str] = None,
+    client: Optional[genai.Client] = None,
 ) -> None:
     """Send text (and optionally images) to Gemini 3 Pro Image Preview and stream responses."""
-    api_key = os.environ.get("GEMINI_API_KEY")
-    if not api_key:
-        print("Error: GEMINI_API_KEY environment variable not set", file=sys.stderr)
-        sys.exit(1)
+    if client is None:
+        api_key = get_api_key()
+        if not api_key:
+            print("Error: GEMINI_API_KEY environment variable not set", file=sys.stderr)
+            sys.exit(1)
 
-    client = genai.Client(api_key=api_key)
+        client = get_client(api_key)
 
     # Build content parts
     parts = [types.Part.from_text(text=prompt)]
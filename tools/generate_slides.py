@@ -1,109 +1,134 @@
 import argparse
-import sys
+import asyncio
 import os
 import re
 from pathlib import Path
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import time
 
-# Import gemini_generate_image from the same directory
+# Import the Gemini wrappers from the same directory
 import gemini_generate_image
+import gemini_enlarge_image
 
-def parse_slides(outline_path, start_slide=1, end_slide=19, specific_slides=None):
-    with open(outline_path, 'r') as f:
-        content = f.read()
-    
-    slides = []
-    # Regex to find slide blocks
-    slide_pattern = re.compile(r'#### Slide (\d+):(.*?)(?=#### Slide \d+:|$)', re.DOTALL)
-    
-    matches = slide_pattern.finditer(content)
-    for match in matches:
-        slide_num = int(match.group(1))
-        
-        # Check constraints
-        if specific_slides and slide_num not in specific_slides:
+# Outline markers; everything else in the outline is passed through as prompt text
+_SLIDE_HEADER = re.compile(r'#### Slide (\d+):')
+_ASSET_HEADER = re.compile(r'\*\s+\*\*Asset\*\*?\s*:?')
+
+def _iter_slide_blocks(f):
+    """Yield (slide_num, lines) for each '#### Slide N:' block, one block at a time."""
+    slide_num = None
+    lines = []
+    for line in f:
+        header_match = _SLIDE_HEADER.match(line) if line.startswith('#### Slide ') else None
+        if header_match:
+            if slide_num is not None:
+                yield slide_num, lines
+            slide_num = int(header_match.group(1))
+            lines = []
+        if slide_num is not None:
+            lines.append(line)
+    if slide_num is not None:
+        yield slide_num, lines
+
+def _is_section_header(stripped):
+    """Match '*<spaces>**Key**' bullets (same as r'\*\s+\*\*') without the regex engine."""
+    return stripped[:1] == '*' and stripped[1:2].isspace() and stripped[1:].lstrip().startswith('**')
+
+def _parse_asset_paths(lines):
+    asset_paths = []
+    in_asset_section = False
+    for line in lines:
+        if not in_asset_section:
+            # Find the Asset section
+            # matches * **Asset**: or * **Asset:** or * **Asset** :
+            asset_header_match = _ASSET_HEADER.search(line) if '**Asset' in line else None
+            if asset_header_match:
+                in_asset_section = True
+                # Check the rest of the line (if content is on the same line as **Asset**:)
+                current_line = line[asset_header_match.end():].strip()
+                if current_line and current_line.lower() != "none":
+                    asset_paths.append(current_line)
             continue
-        if not specific_slides and not (start_slide <= slide_num <= end_slide):
+
+        # Process subsequent lines looking for bullet points
+        stripped = line.strip()
+        if not stripped:
             continue
-            
-        slide_content = match.group(0).strip()
-            
-        # Extract Asset paths
-        asset_paths = []
-        
-        # Find the Asset section
-        # matches * **Asset**: or * **Asset:** or * **Asset** :
-        asset_header_match = re.search(r'\*\s+\*\*Asset\*\*?\s*:?', slide_content)
-        
-        if asset_header_match:
-            # Get the text following the header
-            rest_of_section = slide_content[asset_header_match.end():]
-            
-            # Split into lines
-            lines = rest_of_section.split('\n')
-            
-            # Check the first line (if content is on the same line as **Asset**:)
-            current_line = lines[0].strip()
-            if current_line and current_line.lower() != "none":
-                asset_paths.append(current_line)
-            
-            # Process subsequent lines looking for bullet points
-            for line in lines[1:]:
-                stripped = line.strip()
-                if not stripped:
-                    continue
-                    
-                # Stop if we hit a new major section (indicated by * **Key**:)
-                if re.match(r'^\*\s+\*\*', stripped) and not stripped.startswith('* **Asset'):
-                        break
-                
-                # Check for list items
-                if stripped.startswith('* ') or stripped.startswith('- '):
-                    val = stripped[2:].strip()
-                    if val.lower() != "none":
-                        asset_paths.append(val)
-
-        slides.append({
-            'number': slide_num,
-            'content': slide_content,
-            'asset_paths': asset_paths
-        })
+
+        # Stop if we hit a new major section (indicated by * **Key**:)
+        if _is_section_header(stripped) and not stripped.startswith('* **Asset'):
+            break
+
+        # Check for list items
+        if stripped.startswith('* ') or stripped.startswith('- '):
+            val = stripped[2:].strip()
+            if val.lower() != "none":
+                asset_paths.append(val)
+    return asset_paths
+
+def parse_slides(outline_path, start_slide=1, end_slide=19, specific_slides=None):
+    slides = []
+    # Slides are numbered in order in the outline, so nothing past this one is needed
+    last_slide = max(specific_slides) if specific_slides else end_slide
+    with open(outline_path, 'r') as f:
+        # Read the outline line by line so only one slide block is held at a time
+        for slide_num, lines in _iter_slide_blocks(f):
+            if slide_num > last_slide:
+                break
+
+            # Check constraints
+            if specific_slides and slide_num not in specific_slides:
+                continue
+            if not specific_slides and not (start_slide <= slide_num <= end_slide):
+                continue
+
+            slides.append({
+                'number': slide_num,
+                'content': ''.join(lines).strip(),
+                'asset_paths': _parse_asset_paths(lines)
+            })
     return slides
 
-def generate_slide(slide, guideline, output_dir, project_root):
-    print(f"Starting generation for Slide {slide['number']}...")
+# Slide-independent tail of the generation prompt
+PROMPT_TAIL = """
     
-    prompt = f"""
+    TASK:
+    Generate a high-resolution, 16:9 slide image that perfectly represents the content above while strictly adhering to the visual guidelines. 
+    The image should be the final slide itself, including any text or graphical elements described.
+    Make it look like a professional slide from a Keynote presentation.
+    """
+
+def build_prompt_header(guideline):
+    """Build the slide-independent prompt prefix once so workers only append slide content."""
+    return f"""
     You are an expert presentation designer for a high-end tech keynote.
     
     VISUAL GUIDELINES (MUST FOLLOW):
     {guideline}
     
     SLIDE CONTENT:
-    {slide['content']}
-    
-    TASK:
-    Generate a high-resolution, 16:9 slide image that perfectly represents the content above while strictly adhering to the visual guidelines. 
-    The image should be the final slide itself, including any text or graphical elements described.
-    Make it look like a professional slide from a Keynote presentation.
     """
+
+def generate_slide(slide, prompt_header, output_dir, project_root, client=None):
+    print(f"Starting generation for Slide {slide['number']}...")
+    
+    # Collect the prompt pieces and join them once, instead of re-copying the
+    # whole prompt for every asset note
+    prompt_parts = [prompt_header, slide['content'], PROMPT_TAIL]
     
     image_inputs = []
     if slide.get('asset_paths'):
         for path_str in slide['asset_paths']:
-            # Resolve asset path relative to project root
-            if not os.path.isabs(path_str):
-                asset_path = project_root / path_str
-            else:
-                asset_path = Path(path_str)
+            # Resolve asset path relative to project root (absolute paths are kept as-is)
+            asset_path = project_root / path_str
             
             if asset_path.exists():
                 print(f"  Using asset: {asset_path}")
-                prompt += f"\n    NOTE: Incorporate the provided reference image ({asset_path.name}) into the design as described."
+                prompt_parts.append(f"\n    NOTE: Incorporate the provided reference image ({asset_path.name}) into the design as described.")
                 image_inputs.append(str(asset_path))
             else:
                 print(f"  WARNING: Asset file not found at {asset_path}. Skipping this asset.")
+    prompt = ''.join(prompt_parts)
 
     output_filename = os.path.join(str(output_dir), f"slide_{slide['number']:02d}")
     
@@ -113,7 +138,8 @@ def generate_slide(slide, guideline, output_dir, project_root):
             image_paths=image_inputs if image_inputs else None,
             output_prefix=output_filename,
             image_size="1K", 
-            aspect_ratio="16:9"
+            aspect_ratio="16:9",
+            client=client
         )
         print(f"Finished Slide {slide['number']}")
     except Exception as e:
@@ -123,6 +149,7 @@ def main():
     parser = argparse.ArgumentParser(description="Generate slides")
     parser.add_argument("--enlarge", action="store_true", help="Enlarge existing slides to 4K")
     parser.add_argument("--slides", type=int, nargs="+", help="Specific slide numbers to process (e.g., --slides 8 11)")
+    parser.add_argument("--workers", "-w", type=int, default=None, help="Number of parallel requests (default: one per slide, capped by GEMINI_MAX_CONCURRENCY or 16)")
     args = parser.parse_args()
 
     # Get project root directory (parent of tools directory)
@@ -137,53 +164,46 @@ def main():
     
     if args.enlarge:
         # Enlarge mode: Iterate over existing slides
-        import glob
-        import subprocess
-        
         print("Starting batch enlargement...")
-        # Find all slide_XX_0.jpg files (but not already enlarged ones)
-        slide_pattern = str(output_dir / "slide_*_0.jpg")
-        files = glob.glob(slide_pattern)
-        
-        # Filter if --slides is provided
-        if args.slides:
-            filtered_files = []
-            for f in files:
-                # Extract number from filename slide_XX_0.jpg
-                match = re.search(r'slide_(\d+)_0.jpg', f)
-                if match:
-                    num = int(match.group(1))
-                    if num in args.slides:
-                        filtered_files.append(f)
-            files = filtered_files
+        # Find all slide_XX_0.jpg files (but not already enlarged ones),
+        # keeping only the requested numbers if --slides is provided
+        wanted = set(args.slides) if args.slides else None
+        files = []
+        with os.scandir(output_dir) as entries:
+            for entry in entries:
+                name = entry.name
+                if not (name.startswith("slide_") and name.endswith("_0.jpg")) or len(name) < 12:
+                    continue
+                if wanted is not None:
+                    # Extract number from filename slide_XX_0.jpg
+                    num = name[6:-6]
+                    if not num.isdigit() or int(num) not in wanted:
+                        continue
+                if entry.is_file():
+                    files.append(entry.path)
             
         print(f"Found {len(files)} slides to enlarge.")
         
+        pairs = []
         for file_path in sorted(files):
             file_path_obj = Path(file_path)
             # Define output path: slide_XX_0_4k.jpg
             # OR user said "use suffix to distinguish"
             output_name = file_path_obj.stem + "_4k" + file_path_obj.suffix
-            output_path = output_dir / output_name
-            
-            print(f"Enlarging {file_path_obj.name} -> {output_name}...")
-            
-            # Call gemini_enlarge_image.py
-            enlarge_script = script_dir / "gemini_enlarge_image.py"
-            # Using current python interpreter
-            cmd = [sys.executable, str(enlarge_script), "--input", str(file_path), "--output", str(output_path)]
-            
-            try:
-                subprocess.run(cmd, check=True)
-                print(f"Finished {output_name}")
-            except subprocess.CalledProcessError as e:
-                print(f"Failed to enlarge {file_path_obj.name}: {e}")
+            pairs.append((file_path, str(output_dir / output_name)))
+
+        # Enlarge in-process; the API call is network-bound, so one event loop
+        # multiplexes all requests
+        api_key = gemini_generate_image.get_api_key()
+        workers = gemini_enlarge_image.worker_count(len(pairs), args.workers)
+        asyncio.run(gemini_enlarge_image.enlarge_many(pairs, api_key, workers))
         
         print("Batch enlargement complete.")
         return
 
     with open(guideline_path, 'r') as f:
         guideline = f.read()
+    prompt_header = build_prompt_header(guideline)
         
     # Generate mode
     # Use --slides arg if present, otherwise default to all (or whatever logic)
@@ -201,14 +221,21 @@ def main():
         slides = parse_slides(str(outline_path), specific_slides=specific_slides) 
     
     print(f"Found {len(slides)} slides to generate.")
+
+    # One client for all workers so they share a connection pool
+    # (without a key, generate() reports the missing key itself)
+    api_key = gemini_generate_image.get_api_key()
+    client = gemini_generate_image.get_client(api_key) if api_key else None
     
-    with ThreadPoolExecutor(max_workers=4) as executor: 
+    workers = gemini_enlarge_image.worker_count(len(slides), args.workers)
+    with ThreadPoolExecutor(max_workers=workers) as executor: 
         futures = [
-            executor.submit(generate_slide, slide, guideline, output_dir, project_root)
+            executor.submit(generate_slide, slide, prompt_header, output_dir, project_root, client)
             for slide in slides
         ]
         
-        for future in futures:
+        # Surface failures as soon as they happen rather than in submission order
+        for future in as_completed(futures):
             future.result()
 
 if __name__ == "__main__":